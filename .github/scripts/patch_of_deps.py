@@ -10,8 +10,9 @@ from __future__ import annotations
 import re
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Iterable, List, Sequence, Tuple
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
 
 import shlex
 
@@ -27,6 +28,21 @@ REPLACEMENTS: Sequence[Tuple[str, str]] = (
     ),
 )
 
+# All replacements fused into one alternation so the script is scanned once.
+# Each pattern gets its own named group; ``lastgroup`` picks the replacement.
+# An empty table would compile to "" and match everywhere, so it gets None.
+_REPLACEMENT_RE: Optional[re.Pattern[str]] = (
+    re.compile(
+        "|".join(
+            f"(?P<g{idx}>{pattern})"
+            for idx, (pattern, _) in enumerate(REPLACEMENTS)
+        )
+    )
+    if REPLACEMENTS
+    else None
+)
+_REPLACEMENT_TABLE: Sequence[str] = tuple(repl for _, repl in REPLACEMENTS)
+
 # Shell tokens we should not try to treat as packages.
 CONTROL_TOKENS = {
     "&&",
@@ -51,10 +67,86 @@ CONTROL_TOKENS = {
 # command substitutions survive untouched.
 PACKAGE_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9.+-]*")
 
+# How _join_tokens spaces shell operators: "attach" glues the operator to the
+# previous word, "infix" sets it off with a leading space. Everything else is
+# a plain word and gets a leading space unless it follows an opening paren.
+_JOIN_GLUE = {
+    ";": "attach",
+    "(": "attach",
+    ")": "attach",
+    "&&": "infix",
+    "||": "infix",
+    "|": "infix",
+    "&": "infix",
+}
+
+# Per-line helpers for the install-command scan, compiled once up front.
+_APT_GET_RE = re.compile(r"\bapt-get\b")
+_LEAD_WS_RE = re.compile(r"\s*")
+
+# Without quotes or escapes, shlex in posix mode with our punctuation set
+# reduces to "runs of punctuation" and "runs of everything else", which a
+# compiled pattern can split far faster than shlex's per-character loop.
+_SIMPLE_TOKEN_RE = re.compile(r"[;&|()]+|[^ \t\r\n;&|()]+")
+_SHLEX_ONLY_CHARS = frozenset("'\"\\")
+
+
+# Upper bound on concurrent apt-cache processes when probing package by
+# package, so a long straggler list does not fork a process per name at once
+# and swamp the runner's CPUs.
+PROBE_WORKERS = 8
+
+# Probe results keyed by package name. The batched probe records the names it
+# confirms in one go; only stragglers fall back to a per-package probe.
+_CANDIDATE_CACHE: Dict[str, bool] = {}
+
+# apt-cache prints one RFC822-style record per package; the header is all we
+# need to know the name resolved. Matched against raw bytes so the (mostly
+# description) output never has to be decoded.
+_PACKAGE_HEADER_RE = re.compile(rb"^Package:[ \t]*(\S+)", re.MULTILINE)
+
+
+def apt_candidates_exist(packages: Sequence[str]) -> Dict[str, bool]:
+    """Probe every name in *packages* with a single ``apt-cache show`` call.
+
+    Only names that come back with their own ``Package:`` record are reported
+    (as True). Anything else stays unresolved: a virtual package with a
+    provider prints no record yet still installs, so absence here is not proof
+    the name is missing.
+    """
+
+    if not packages:
+        return {}
+
+    try:
+        result = subprocess.run(
+            ["apt-cache", "show", "--no-all-versions", *packages],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=False,
+        )
+    except FileNotFoundError:  # pragma: no cover - defensive guard
+        return {package: False for package in packages}
+    except OSError:  # pragma: no cover - e.g. argument list too long
+        # Leave everything unresolved so the caller can fall back to
+        # per-package probes.
+        return {}
+
+    found = {
+        name.decode("ascii", errors="replace")
+        for name in _PACKAGE_HEADER_RE.findall(result.stdout)
+    }
+
+    return {package: True for package in packages if package in found}
+
 
 def apt_candidate_exists(package: str) -> bool:
     """Return True if apt knows how to install *package* on this runner."""
 
+    cached = _CANDIDATE_CACHE.get(package)
+    if cached is not None:
+        return cached
+
     try:
         result = subprocess.run(
             ["apt-cache", "show", package],
@@ -65,7 +157,27 @@ def apt_candidate_exists(package: str) -> bool:
     except FileNotFoundError:  # pragma: no cover - defensive guard
         return False
 
-    return result.returncode == 0
+    exists = result.returncode == 0
+    _CANDIDATE_CACHE[package] = exists
+    return exists
+
+
+def _prewarm_candidates(packages: Iterable[str]) -> None:
+    """Probe *packages* one by one, in parallel, to fill the cache.
+
+    This is the normal path for every name the batched probe leaves
+    unresolved: virtual packages, genuinely missing names, or everything if
+    the batch could not run at all. Each probe is a subprocess, so threads
+    overlap the waits without GIL contention.
+    """
+
+    pending = [pkg for pkg in packages if pkg not in _CANDIDATE_CACHE]
+    if not pending:
+        return
+
+    with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as pool:
+        for _ in pool.map(apt_candidate_exists, pending):
+            pass
 
 
 def _collect_install_block(lines: List[str], start: int) -> Tuple[int, List[str]]:
@@ -94,6 +206,9 @@ def _normalize_command(block: Iterable[str]) -> str:
 def _shell_split(command: str) -> List[str]:
     """Split *command* into shell tokens while preserving punctuation."""
 
+    if _SHLEX_ONLY_CHARS.isdisjoint(command):
+        return _SIMPLE_TOKEN_RE.findall(command)
+
     lexer = shlex.shlex(command, posix=True, punctuation_chars=";&|()")
     lexer.whitespace_split = True
     lexer.commenters = ""
@@ -106,55 +221,34 @@ def _join_tokens(tokens: Sequence[str]) -> str:
     if not tokens:
         return ""
 
-    pieces: List[str] = []
-    for token in tokens:
-        if not pieces:
+    pieces: List[str] = [tokens[0]]
+    after_open = tokens[0].endswith("(")
+    for token in tokens[1:]:
+        glue = _JOIN_GLUE.get(token)
+        if glue == "attach" or (glue is None and after_open):
             pieces.append(token)
-            continue
-
-        if token == ";":
-            if pieces:
-                pieces[-1] += ";"
-            else:
-                pieces.append(";")
-            continue
-
-        if token in {"&&", "||", "|", "&"}:
+        else:
             pieces.append(" " + token)
-            continue
-
-        if token == "(":
-            if pieces:
-                pieces[-1] += "("
-            else:
-                pieces.append("(")
-            continue
-
-        if token == ")":
-            if pieces:
-                pieces[-1] += ")"
-            else:
-                pieces.append(")")
-            continue
-
-        if pieces[-1].endswith("("):
-            pieces.append(token)
-            continue
-
-        pieces.append(" " + token)
+        after_open = token.endswith("(")
 
     return "".join(pieces)
 
 
-def _rewrite_install_command(
-    tokens: List[str],
-) -> Tuple[List[str], List[str]]:
-    """Remove dead packages from the parsed apt-get install command."""
+def _split_install_command(
+    tokens: Sequence[str],
+) -> Optional[
+    Tuple[Sequence[str], Sequence[str], Sequence[str], Sequence[str]]
+]:
+    """Slice *tokens* around the apt-get install arguments.
+
+    Returns ``(prefix, pre_install, post_install, suffix)`` or ``None`` when the
+    tokens do not contain an apt-get install command.
+    """
 
     try:
         apt_idx = tokens.index("apt-get")
     except ValueError:
-        return tokens, []
+        return None
 
     split_idx = len(tokens)
     for idx in range(apt_idx, len(tokens)):
@@ -172,38 +266,72 @@ def _rewrite_install_command(
             install_idx = idx
             break
     if install_idx is None:
-        return tokens, []
+        return None
 
     pre_install = command_tokens[: install_idx + 1]
     post_install = command_tokens[install_idx + 1 :]
+    return prefix_tokens, pre_install, post_install, suffix_tokens
+
+
+def _classify_token(token: str) -> str:
+    """Label an install argument as ``dynamic``, ``package`` or ``other``."""
+
+    # PACKAGE_RE anchors on an alphanumeric first character and never admits
+    # ``$`` or backticks, so plain package names settle with one match and
+    # flags fail on their first byte.
+    if PACKAGE_RE.fullmatch(token):
+        return "package"
+    if "$" in token or "`" in token:
+        return "dynamic"
+    return "other"
+
+
+def _probe_candidates(post_install: Iterable[str]) -> Iterable[str]:
+    """Yield the install arguments that need an apt lookup."""
+
+    for token in post_install:
+        if _classify_token(token) == "package":
+            yield token
+
+
+def _rewrite_install_command(
+    tokens: List[str],
+) -> Optional[Tuple[List[str], List[str]]]:
+    """Remove dead packages from the parsed apt-get install command.
+
+    Returns ``None`` when the command would come back unchanged (nothing
+    dropped and a package left to install) so callers can leave the original
+    text alone instead of re-joining identical tokens.
+    """
+
+    parts = _split_install_command(tokens)
+    if parts is None:
+        return None
+    prefix_tokens, pre_install, post_install, suffix_tokens = parts
 
     new_tail: List[str] = []
     skipped: List[str] = []
-    saw_dynamic_package = False
+    has_package = False
     for token in post_install:
-        if "$" in token or "`" in token:
-            saw_dynamic_package = True
+        kind = _classify_token(token)
+        if kind == "dynamic":
+            has_package = True
             new_tail.append(token)
-            continue
-
-        if token.startswith("-") or not PACKAGE_RE.fullmatch(token):
+        elif kind == "other":
             new_tail.append(token)
-            continue
-
-        if apt_candidate_exists(token):
+        elif apt_candidate_exists(token):
+            has_package = True
             new_tail.append(token)
         else:
             skipped.append(token)
 
-    has_package = saw_dynamic_package or any(
-        PACKAGE_RE.fullmatch(token) and not token.startswith("-")
-        for token in new_tail
-    )
+    if not skipped and has_package:
+        return None
 
     if has_package:
-        new_tokens = prefix_tokens + pre_install + new_tail + suffix_tokens
+        new_tokens = [*prefix_tokens, *pre_install, *new_tail, *suffix_tokens]
     else:
-        new_tokens = prefix_tokens + ["true"] + suffix_tokens
+        new_tokens = [*prefix_tokens, "true", *suffix_tokens]
 
     return new_tokens, skipped
 
@@ -211,9 +339,15 @@ def _rewrite_install_command(
 def strip_missing_packages(script_text: str) -> Tuple[str, List[str]]:
     """Rewrite apt install invocations so missing packages get dropped."""
 
+    if "apt-get" not in script_text:
+        return script_text, []
+
     lines = script_text.splitlines()
-    skipped_packages: List[str] = []
-    changed = False
+
+    # First pass: lex every install command and gather the package names so
+    # apt only has to be asked once for the whole script.
+    blocks: List[Tuple[int, int, str, str, List[str]]] = []
+    candidates: Set[str] = set()
     i = 0
     while i < len(lines):
         line = lines[i]
@@ -221,48 +355,81 @@ def strip_missing_packages(script_text: str) -> Tuple[str, List[str]]:
             i += 1
             continue
 
-        if not re.search(r"\bapt-get\b", line) or "install" not in line:
+        # Cheap substring checks first; the word-boundary regex only runs on
+        # the handful of lines that could actually be install commands.
+        if "apt-get" not in line or "install" not in line:
+            i += 1
+            continue
+        if not _APT_GET_RE.search(line):
             i += 1
             continue
 
         end, block = _collect_install_block(lines, i)
-        indent = re.match(r"\s*", block[0]).group(0)
+        indent = _LEAD_WS_RE.match(block[0]).group(0)
         logical = _normalize_command(block)
-        if not logical:
-            i = end + 1
-            continue
+        if logical:
+            tokens = _shell_split(logical)
+            parts = _split_install_command(tokens)
+            if parts is not None:
+                candidates.update(_probe_candidates(parts[2]))
+            blocks.append((i, end, indent, logical, tokens))
+        i = end + 1
+
+    # The batch only confirms names; stragglers fall back to the per-package
+    # return-code probe.
+    unknown = sorted(candidates.difference(_CANDIDATE_CACHE))
+    _CANDIDATE_CACHE.update(apt_candidates_exist(unknown))
+    _prewarm_candidates(unknown)
 
-        tokens = _shell_split(logical)
-        new_tokens, skipped = _rewrite_install_command(tokens)
-        if skipped:
-            skipped_packages.extend(skipped)
+    # Second pass: rewrite using the primed cache, copying untouched lines
+    # straight into the output buffer.
+    skipped_packages: List[str] = []
+    out: List[str] = []
+    cursor = 0
+    changed = False
+    for start, end, indent, logical, tokens in blocks:
+        result = _rewrite_install_command(tokens)
+        if result is None:
+            continue
+        new_tokens, skipped = result
+        skipped_packages.extend(skipped)
 
         new_command = indent + _join_tokens(new_tokens)
         original_command = indent + logical
         if new_command != original_command:
             changed = True
-            lines[i] = new_command
-            for remove_idx in range(i + 1, end + 1):
-                lines[remove_idx] = None  # type: ignore[index]
-        i = end + 1
+            out.extend(lines[cursor:start])
+            out.append(new_command)
+            cursor = end + 1
 
     if changed:
-        new_lines = [line for line in lines if line is not None]
+        out.extend(lines[cursor:])
         # Preserve the trailing newline from the original text if one existed.
         trailing_newline = "\n" if script_text.endswith("\n") else ""
-        rewritten = "\n".join(new_lines) + trailing_newline
+        rewritten = "\n".join(out) + trailing_newline
         return rewritten, skipped_packages
 
     return script_text, skipped_packages
 
 
+def _replace_match(match: re.Match[str]) -> str:
+    """Return the REPLACEMENTS entry for whichever pattern *match* hit.
+
+    The replacement is returned literally: unlike a string passed to
+    ``re.sub``, backslash escapes and group references are not expanded, so
+    REPLACEMENTS entries must not rely on them.
+    """
+
+    return _REPLACEMENT_TABLE[int(match.lastgroup[1:])]
+
+
 def patch_dependency_helper(target: Path) -> None:
     """Rewrite the dependency helper in-place with modern package names."""
 
     original = target.read_text()
     patched = original
-    for pattern, replacement in REPLACEMENTS:
-        patched = re.sub(pattern, replacement, patched)
+    if _REPLACEMENT_RE is not None:
+        patched = _REPLACEMENT_RE.sub(_replace_match, patched)
 
     patched, skipped = strip_missing_packages(patched)
 